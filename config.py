@@ -1,117 +1,149 @@
 import os
 import logging
+import logging.config
+import dataclasses
 from dataclasses import dataclass, field
-from typing import Optional, List, Dict, Any
+from functools import cache
+from typing import Optional, List, Dict, Any, FrozenSet
 from dotenv import load_dotenv
 
-# Загружаем переменные окружения
-load_dotenv()
+# Загружаем переменные окружения. Сентинел в os.environ гарантирует,
+# что .env парсится один раз на процесс (повторные импорты/релоады и
+# дочерние процессы не перечитывают файл); DOTENV_DISABLE=1 отключает
+# чтение .env совсем (для продакшена, где окружение задаётся снаружи)
+if not os.environ.get('DOTENV_DISABLE') and not os.environ.get('_INSTA_BOT_DOTENV_LOADED'):
+    load_dotenv()
+    os.environ['_INSTA_BOT_DOTENV_LOADED'] = '1'
 
-@dataclass
+logger = logging.getLogger(__name__)
+
+# Снимок окружения: один раз материализуем os.environ в обычный dict,
+# чтобы поля dataclass'ов не ходили в os.getenv по 50+ раз при импорте
+_ENV: Dict[str, str] = dict(os.environ)
+
+# Значения, которые считаем истинными в булевых переменных окружения
+_TRUTHY = frozenset({'true', '1', 'yes', 'on'})
+
+def _envbool(key: str, default: bool = False) -> bool:
+    """Булева переменная окружения ('true'/'1'/'yes'/'on' == True)"""
+    value = _ENV.get(key)
+    if value is None:
+        return default
+    return value.strip().lower() in _TRUTHY
+
+def _envint(key: str, default: int) -> int:
+    """Целочисленная переменная окружения"""
+    value = _ENV.get(key)
+    return default if value is None else int(value)
+
+# Допустимые уровни логирования (frozenset — O(1) проверка в validate())
+_VALID_LOG_LEVELS = frozenset({'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'})
+_VALID_LOG_LEVELS_ERROR = "LOG_LEVEL must be one of: " + ', '.join(sorted(_VALID_LOG_LEVELS))
+
+@dataclass(slots=True)
 class DatabaseConfig:
     """Конфигурация базы данных"""
-    url: str = os.getenv('DATABASE_URL', 'sqlite:///enhanced_instagram_bot.db')
-    echo: bool = os.getenv('DB_ECHO', 'false').lower() == 'true'
-    pool_size: int = int(os.getenv('DB_POOL_SIZE', '5'))
-    max_overflow: int = int(os.getenv('DB_MAX_OVERFLOW', '10'))
-    pool_timeout: int = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+    url: str = _ENV.get('DATABASE_URL', 'sqlite:///enhanced_instagram_bot.db')
+    echo: bool = _envbool('DB_ECHO')
+    pool_size: int = _envint('DB_POOL_SIZE', 5)
+    max_overflow: int = _envint('DB_MAX_OVERFLOW', 10)
+    pool_timeout: int = _envint('DB_POOL_TIMEOUT', 30)
 
-@dataclass
+@dataclass(slots=True)
 class SecurityConfig:
     """Конфигурация безопасности"""
-    encryption_password: str = os.getenv('ENCRYPTION_PASSWORD', 'default_password_change_me')
+    encryption_password: str = _ENV.get('ENCRYPTION_PASSWORD', 'default_password_change_me')
     allowed_users: Optional[List[int]] = field(default_factory=lambda: [
-        int(x) for x in os.getenv('ALLOWED_USERS', '').split(',') if x.strip()
+        int(x) for x in _ENV.get('ALLOWED_USERS', '').split(',') if x.strip()
     ])
-    webhook_secret: Optional[str] = os.getenv('WEBHOOK_SECRET')
-    rate_limit_enabled: bool = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
-    max_requests_per_hour: int = int(os.getenv('MAX_REQUESTS_PER_HOUR', '200'))
+    webhook_secret: Optional[str] = _ENV.get('WEBHOOK_SECRET')
+    rate_limit_enabled: bool = _envbool('RATE_LIMIT_ENABLED', True)
+    max_requests_per_hour: int = _envint('MAX_REQUESTS_PER_HOUR', 200)
 
-@dataclass
+@dataclass(slots=True)
 class TelegramConfig:
     """Конфигурация Telegram бота"""
-    token: str = os.getenv('TELEGRAM_TOKEN', '')
-    webhook_url: Optional[str] = os.getenv('WEBHOOK_URL')
-    use_webhook: bool = os.getenv('USE_WEBHOOK', 'false').lower() == 'true'
-    webhook_port: int = int(os.getenv('WEBHOOK_PORT', '8443'))
-    webhook_listen: str = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    token: str = _ENV.get('TELEGRAM_TOKEN', '')
+    webhook_url: Optional[str] = _ENV.get('WEBHOOK_URL')
+    use_webhook: bool = _envbool('USE_WEBHOOK')
+    webhook_port: int = _envint('WEBHOOK_PORT', 8443)
+    webhook_listen: str = _ENV.get('WEBHOOK_LISTEN', '0.0.0.0')
 
-@dataclass
+@dataclass(slots=True)
 class InstagramConfig:
     """Конфигурация Instagram API"""
-    requests_per_hour: int = int(os.getenv('INSTAGRAM_REQUESTS_PER_HOUR', '200'))
-    posts_per_day: int = int(os.getenv('INSTAGRAM_POSTS_PER_DAY', '50'))
-    stories_per_day: int = int(os.getenv('INSTAGRAM_STORIES_PER_DAY', '100'))
-    reels_per_day: int = int(os.getenv('INSTAGRAM_REELS_PER_DAY', '20'))
-    session_timeout: int = int(os.getenv('INSTAGRAM_SESSION_TIMEOUT', '3600'))
-    max_login_attempts: int = int(os.getenv('INSTAGRAM_MAX_LOGIN_ATTEMPTS', '3'))
+    requests_per_hour: int = _envint('INSTAGRAM_REQUESTS_PER_HOUR', 200)
+    posts_per_day: int = _envint('INSTAGRAM_POSTS_PER_DAY', 50)
+    stories_per_day: int = _envint('INSTAGRAM_STORIES_PER_DAY', 100)
+    reels_per_day: int = _envint('INSTAGRAM_REELS_PER_DAY', 20)
+    session_timeout: int = _envint('INSTAGRAM_SESSION_TIMEOUT', 3600)
+    max_login_attempts: int = _envint('INSTAGRAM_MAX_LOGIN_ATTEMPTS', 3)
 
-@dataclass
+@dataclass(slots=True)
 class MediaConfig:
     """Конфигурация медиафайлов"""
-    max_file_size: int = int(os.getenv('MAX_FILE_SIZE', '52428800'))  # 50MB
-    max_video_duration: int = int(os.getenv('MAX_VIDEO_DURATION', '60'))  # seconds
-    max_reel_duration: int = int(os.getenv('MAX_REEL_DURATION', '90'))  # seconds
-    allowed_photo_formats: List[str] = field(default_factory=lambda: ['jpg', 'jpeg', 'png', 'webp'])
-    allowed_video_formats: List[str] = field(default_factory=lambda: ['mp4', 'mov', 'avi', 'mkv'])
-    temp_dir: str = os.getenv('TEMP_DIR', 'tmp')
+    max_file_size: int = _envint('MAX_FILE_SIZE', 52428800)  # 50MB
+    max_video_duration: int = _envint('MAX_VIDEO_DURATION', 60)  # seconds
+    max_reel_duration: int = _envint('MAX_REEL_DURATION', 90)  # seconds
+    # frozenset: проверки `ext in allowed_*_formats` в обработчиках — O(1)
+    allowed_photo_formats: FrozenSet[str] = frozenset({'jpg', 'jpeg', 'png', 'webp'})
+    allowed_video_formats: FrozenSet[str] = frozenset({'mp4', 'mov', 'avi', 'mkv'})
+    temp_dir: str = _ENV.get('TEMP_DIR', 'tmp')
     
     def __post_init__(self):
         """Создаем временную директорию если её нет"""
-        if not os.path.exists(self.temp_dir):
-            os.makedirs(self.temp_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
 
-@dataclass
+@dataclass(slots=True)
 class SchedulerConfig:
     """Конфигурация планировщика"""
-    interval: int = int(os.getenv('SCHEDULER_INTERVAL', '10'))  # seconds
-    max_concurrent_jobs: int = int(os.getenv('MAX_CONCURRENT_JOBS', '5'))
-    retry_delay: int = int(os.getenv('RETRY_DELAY', '60'))  # seconds
-    max_retries: int = int(os.getenv('MAX_RETRIES', '3'))
-    timezone: str = os.getenv('DEFAULT_TIMEZONE', 'UTC')
+    interval: int = _envint('SCHEDULER_INTERVAL', 10)  # seconds
+    max_concurrent_jobs: int = _envint('MAX_CONCURRENT_JOBS', 5)
+    retry_delay: int = _envint('RETRY_DELAY', 60)  # seconds
+    max_retries: int = _envint('MAX_RETRIES', 3)
+    timezone: str = _ENV.get('DEFAULT_TIMEZONE', 'UTC')
 
-@dataclass
+@dataclass(slots=True)
 class LoggingConfig:
     """Конфигурация логирования"""
-    level: str = os.getenv('LOG_LEVEL', 'INFO')
-    format: str = os.getenv('LOG_FORMAT', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    log_dir: str = os.getenv('LOG_DIR', 'logs')
-    max_file_size: int = int(os.getenv('LOG_MAX_FILE_SIZE', '10485760'))  # 10MB
-    backup_count: int = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+    level: str = _ENV.get('LOG_LEVEL', 'INFO')
+    format: str = _ENV.get('LOG_FORMAT', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_dir: str = _ENV.get('LOG_DIR', 'logs')
+    max_file_size: int = _envint('LOG_MAX_FILE_SIZE', 10485760)  # 10MB
+    backup_count: int = _envint('LOG_BACKUP_COUNT', 5)
     
     def __post_init__(self):
         """Создаем директорию логов если её нет"""
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir, exist_ok=True)
+        os.makedirs(self.log_dir, exist_ok=True)
 
-@dataclass
+@dataclass(slots=True)
 class NotificationConfig:
     """Конфигурация уведомлений"""
-    enabled: bool = os.getenv('NOTIFICATIONS_ENABLED', 'true').lower() == 'true'
-    weekly_reports: bool = os.getenv('WEEKLY_REPORTS', 'true').lower() == 'true'
-    success_notifications: bool = os.getenv('SUCCESS_NOTIFICATIONS', 'true').lower() == 'true'
-    error_notifications: bool = os.getenv('ERROR_NOTIFICATIONS', 'true').lower() == 'true'
-    report_day: int = int(os.getenv('REPORT_DAY', '1'))  # Monday = 1
-    report_hour: int = int(os.getenv('REPORT_HOUR', '9'))  # 9 AM
+    enabled: bool = _envbool('NOTIFICATIONS_ENABLED', True)
+    weekly_reports: bool = _envbool('WEEKLY_REPORTS', True)
+    success_notifications: bool = _envbool('SUCCESS_NOTIFICATIONS', True)
+    error_notifications: bool = _envbool('ERROR_NOTIFICATIONS', True)
+    report_day: int = _envint('REPORT_DAY', 1)  # Monday = 1
+    report_hour: int = _envint('REPORT_HOUR', 9)  # 9 AM
 
-@dataclass
+@dataclass(slots=True)
 class RedisConfig:
     """Конфигурация Redis (опционально)"""
-    url: Optional[str] = os.getenv('REDIS_URL')
-    enabled: bool = os.getenv('REDIS_ENABLED', 'false').lower() == 'true'
-    db: int = int(os.getenv('REDIS_DB', '0'))
-    max_connections: int = int(os.getenv('REDIS_MAX_CONNECTIONS', '20'))
-    socket_timeout: int = int(os.getenv('REDIS_SOCKET_TIMEOUT', '30'))
+    url: Optional[str] = _ENV.get('REDIS_URL')
+    enabled: bool = _envbool('REDIS_ENABLED')
+    db: int = _envint('REDIS_DB', 0)
+    max_connections: int = _envint('REDIS_MAX_CONNECTIONS', 20)
+    socket_timeout: int = _envint('REDIS_SOCKET_TIMEOUT', 30)
 
-@dataclass
+@dataclass(slots=True)
 class MonitoringConfig:
     """Конфигурация мониторинга"""
-    sentry_dsn: Optional[str] = os.getenv('SENTRY_DSN')
-    enable_metrics: bool = os.getenv('ENABLE_METRICS', 'false').lower() == 'true'
-    metrics_port: int = int(os.getenv('METRICS_PORT', '8000'))
-    health_check_port: int = int(os.getenv('HEALTH_CHECK_PORT', '8001'))
+    sentry_dsn: Optional[str] = _ENV.get('SENTRY_DSN')
+    enable_metrics: bool = _envbool('ENABLE_METRICS')
+    metrics_port: int = _envint('METRICS_PORT', 8000)
+    health_check_port: int = _envint('HEALTH_CHECK_PORT', 8001)
 
-@dataclass
+@dataclass(slots=True)
 class BotConfig:
     """Основная конфигурация бота"""
     telegram: TelegramConfig = field(default_factory=TelegramConfig)
@@ -126,10 +158,15 @@ class BotConfig:
     monitoring: MonitoringConfig = field(default_factory=MonitoringConfig)
     
     # Дополнительные настройки
-    debug: bool = os.getenv('DEBUG', 'false').lower() == 'true'
-    environment: str = os.getenv('ENVIRONMENT', 'development')
-    version: str = os.getenv('VERSION', '2.0.0')
-    
+    debug: bool = _envbool('DEBUG')
+    environment: str = _ENV.get('ENVIRONMENT', 'development')
+    version: str = _ENV.get('VERSION', '2.0.0')
+
+    # Кэш словаря для logging.dictConfig (строится один раз)
+    _logging_config: Optional[Dict[str, Any]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
     def __post_init__(self):
         """Валидация конфигурации"""
         self.validate()
@@ -160,16 +197,18 @@ class BotConfig:
             errors.append("MAX_RETRIES must be non-negative")
         
         # Проверяем уровень логирования
-        valid_log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
-        if self.logging.level.upper() not in valid_log_levels:
-            errors.append(f"LOG_LEVEL must be one of: {', '.join(valid_log_levels)}")
+        if self.logging.level.upper() not in _VALID_LOG_LEVELS:
+            errors.append(_VALID_LOG_LEVELS_ERROR)
         
         if errors:
             raise ValueError("Configuration errors:\n" + "\n".join(f"- {error}" for error in errors))
     
     def get_logging_config(self) -> Dict[str, Any]:
-        """Получить конфигурацию для logging.dictConfig"""
-        return {
+        """Получить конфигурацию для logging.dictConfig (кэшируется)"""
+        if self._logging_config is not None:
+            return self._logging_config
+
+        self._logging_config = {
             'version': 1,
             'disable_existing_loggers': False,
             'formatters': {
@@ -216,47 +255,49 @@ class BotConfig:
                 },
             },
         }
-    
+        return self._logging_config
+
     def to_dict(self) -> Dict[str, Any]:
         """Конвертация в словарь (для сериализации)"""
-        return {
-            'telegram': self.telegram.__dict__,
-            'database': self.database.__dict__,
-            'security': {k: v for k, v in self.security.__dict__.items() if k != 'encryption_password'},
-            'instagram': self.instagram.__dict__,
-            'media': self.media.__dict__,
-            'scheduler': self.scheduler.__dict__,
-            'logging': self.logging.__dict__,
-            'notifications': self.notifications.__dict__,
-            'redis': self.redis.__dict__,
-            'monitoring': self.monitoring.__dict__,
-            'debug': self.debug,
-            'environment': self.environment,
-            'version': self.version,
-        }
+        result = {}
+        for name in _BOTCONFIG_PUBLIC_FIELDS:
+            value = getattr(self, name)
+            result[name] = dataclasses.asdict(value) if dataclasses.is_dataclass(value) else value
+        # asdict копирует frozenset как есть, а json.dumps множества
+        # не принимает — приводим их к отсортированным спискам
+        for section in result.values():
+            if isinstance(section, dict):
+                for key, value in section.items():
+                    if isinstance(value, (set, frozenset)):
+                        section[key] = sorted(value)
+        # Пароль шифрования не должен попадать в сериализованный вывод
+        result['security'].pop('encryption_password', None)
+        return result
+
+# Публичные поля BotConfig (вычисляются один раз при импорте; приватные
+# кэши вроде _logging_config в сериализацию не попадают)
+_BOTCONFIG_PUBLIC_FIELDS = tuple(
+    f.name for f in dataclasses.fields(BotConfig) if not f.name.startswith('_')
+)
 
 def load_config() -> BotConfig:
     """Загрузка конфигурации"""
     try:
         config = BotConfig()
-        logging.info("Configuration loaded successfully")
+        logger.info("Configuration loaded successfully")
         return config
     except Exception as e:
-        logging.error(f"Failed to load configuration: {e}")
+        logger.error(f"Failed to load configuration: {e}")
         raise
 
-# Глобальная конфигурация (ленивая загрузка)
-_config = None
-
+@cache
 def get_config() -> BotConfig:
-    """Получить глобальную конфигурацию"""
-    global _config
-    if _config is None:
-        _config = load_config()
-    return _config
+    """Получить глобальную конфигурацию (ленивая загрузка, потокобезопасно)"""
+    return load_config()
 
-# Настройка логирования при импорте модуля
-if __name__ != '__main__':
+# Настройка логирования при импорте модуля: только если корневой логгер
+# ещё не сконфигурирован, чтобы реимпорт не плодил дубликаты хендлеров
+if __name__ != '__main__' and not logging.getLogger().handlers:
     try:
         config = get_config()
         logging.config.dictConfig(config.get_logging_config())
@@ -266,4 +307,4 @@ if __name__ != '__main__':
             level=logging.INFO,
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
-        logging.error(f"Failed to configure logging: {e}")
+        logger.error(f"Failed to configure logging: {e}")
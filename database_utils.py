@@ -5,30 +5,57 @@
 
 import os
 import sys
+import time
 import logging
-import pickle
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, func, case
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
-
-# Добавляем текущую директорию в путь для импорта модулей
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from sqlalchemy.pool import StaticPool
 
 from config import get_config, BotConfig
-from insta_bot import Base, InstagramAccount, Publication, BotMetrics, UserSettings
+from main import Base, InstagramAccount, Publication, BotMetrics, UserSettings
 
 logger = logging.getLogger(__name__)
 
 class DatabaseManager:
     """Менеджер для работы с базой данных"""
-    
+
+    # Время жизни кэша get_database_stats, секунд
+    STATS_CACHE_TTL = 30.0
+
+
     def __init__(self, config: BotConfig):
         self.config = config
-        self.engine = create_engine(config.database.url, echo=config.debug)
-        self.SessionLocal = sessionmaker(bind=self.engine)
+
+        if config.database.url.startswith('sqlite'):
+            # Для SQLite пул соединений не нужен: одно соединение на процесс
+            # без проверки потока (файл открывается один раз)
+            self.engine = create_engine(
+                config.database.url,
+                echo=config.debug,
+                poolclass=StaticPool,
+                connect_args={'check_same_thread': False},
+            )
+        else:
+            # Используем настройки пула из конфигурации; pool_pre_ping
+            # отбрасывает протухшие соединения до выполнения запроса
+            self.engine = create_engine(
+                config.database.url,
+                echo=config.debug,
+                pool_size=config.database.pool_size,
+                max_overflow=config.database.max_overflow,
+                pool_timeout=config.database.pool_timeout,
+                pool_pre_ping=True,
+            )
+
+        self.SessionLocal = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+        # Кэш get_database_stats (см. STATS_CACHE_TTL)
+        self._stats_cache: Optional[Dict[str, Any]] = None
+        self._stats_cache_at = 0.0
     
     def create_tables(self):
         """Создание всех таблиц"""
@@ -44,6 +71,7 @@ class DatabaseManager:
         """Удаление всех таблиц (осторожно!)"""
         try:
             Base.metadata.drop_all(self.engine)
+            self._invalidate_stats_cache()
             logger.info("Database tables dropped successfully")
             return True
         except SQLAlchemyError as e:
@@ -51,105 +79,195 @@ class DatabaseManager:
             return False
     
     def backup_database(self, backup_path: str) -> bool:
-        """Создание резервной копии базы данных"""
+        """Создание резервной копии базы данных
+
+        Бэкап пишется во временный файл и публикуется атомарным
+        os.replace: по целевому пути никогда не лежит обрезанная копия,
+        даже если процесс умер посреди записи.
+        """
+        tmp_path = backup_path + '.tmp'
         try:
             if 'sqlite' in self.config.database.url:
-                # Для SQLite просто копируем файл
-                import shutil
+                # Для SQLite используем штатный online backup API:
+                # копия консистентна даже при параллельных записях (WAL),
+                # в отличие от shutil.copy2 живого файла
+                import sqlite3
                 db_path = self.config.database.url.replace('sqlite:///', '')
-                shutil.copy2(db_path, backup_path)
+                src = sqlite3.connect(db_path)
+                dst = sqlite3.connect(tmp_path)
+                try:
+                    with dst:
+                        src.backup(dst, pages=1024, sleep=0.005)
+                finally:
+                    src.close()
+                    dst.close()
             else:
                 # Для других БД используем pg_dump/mysqldump
-                self._backup_non_sqlite(backup_path)
-            
+                self._backup_non_sqlite(tmp_path)
+
+            os.replace(tmp_path, backup_path)
             logger.info(f"Database backup created: {backup_path}")
             return True
         except Exception as e:
             logger.error(f"Backup failed: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return False
     
     def _backup_non_sqlite(self, backup_path: str):
         """Резервное копирование для PostgreSQL/MySQL"""
         import subprocess
-        
+
         if 'postgresql' in self.config.database.url:
-            cmd = f"pg_dump {self.config.database.url} > {backup_path}"
+            cmd = ['pg_dump', self.config.database.url]
         elif 'mysql' in self.config.database.url:
-            cmd = f"mysqldump {self.config.database.url} > {backup_path}"
+            cmd = ['mysqldump', self.config.database.url]
         else:
             raise ValueError("Unsupported database type for backup")
-        
-        subprocess.run(cmd, shell=True, check=True)
+
+        # Без shell=True: URL не интерполируется в строку команды, а дамп
+        # пишется напрямую в файл, минуя шелл
+        with open(backup_path, 'wb') as f:
+            subprocess.run(cmd, stdout=f, check=True)
     
+    # Размер пачки для bulk_insert_mappings при миграции
+    MIGRATION_CHUNK_SIZE = 1000
+
     def migrate_from_pickle(self, pickle_file: str = 'instagram_accounts.dat') -> bool:
-        """Миграция данных из старого pickle файла"""
+        """Миграция данных из старого pickle файла
+
+        Файл старого формата — данные, пришедшие с диска, поэтому
+        распаковка ограничена простыми типами: произвольные классы
+        в pickle не исполняются.
+        """
+        import pickle
+
+        class _RestrictedUnpickler(pickle.Unpickler):
+            """Разрешает только типы, встречающиеся в старом формате
+            (dict со строками и датами). Целиком builtins открывать
+            нельзя: builtins.eval/exec/getattr вызываются через REDUCE,
+            и подмененный файл исполнил бы произвольный код"""
+
+            ALLOWED = frozenset({
+                ('builtins', 'set'),
+                ('builtins', 'frozenset'),
+                ('builtins', 'bytearray'),
+                ('datetime', 'datetime'),
+                ('datetime', 'date'),
+            })
+
+            def find_class(self, module, name):
+                if (module, name) in self.ALLOWED:
+                    return super().find_class(module, name)
+                raise pickle.UnpicklingError(
+                    f"Forbidden class in accounts file: {module}.{name}"
+                )
+
         if not os.path.exists(pickle_file):
             logger.warning(f"Pickle file {pickle_file} not found")
             return False
-        
+
         try:
             with open(pickle_file, 'rb') as f:
-                old_accounts = pickle.load(f)
-            
+                old_accounts = _RestrictedUnpickler(f).load()
+
             session = self.SessionLocal()
+
+            # Один SELECT на все существующие имена вместо запроса на каждый аккаунт
+            existing = {row[0] for row in session.query(InstagramAccount.username)}
+
+            now = datetime.utcnow()
             migrated_count = 0
-            
+            batch = []
             for username, data in old_accounts.items():
-                # Проверяем, нет ли уже такого аккаунта
-                existing = session.query(InstagramAccount).filter_by(username=username).first()
-                if existing:
+                if username in existing:
                     logger.info(f"Account {username} already exists, skipping")
                     continue
-                
-                # Создаем новую запись
-                account = InstagramAccount(
-                    username=username,
-                    encrypted_password=data.get('encrypted_password', ''),
-                    user_id=str(data.get('user_id', '')),
-                    verification_method=data.get('verification_method'),
-                    last_used=data.get('last_used', datetime.utcnow()),
-                    created_at=data.get('created_at', datetime.utcnow())
-                )
-                
-                session.add(account)
-                migrated_count += 1
-            
+
+                batch.append({
+                    'username': username,
+                    'encrypted_password': data.get('encrypted_password', ''),
+                    'user_id': str(data.get('user_id', '')),
+                    'verification_method': data.get('verification_method'),
+                    'last_used': data.get('last_used', now),
+                    'created_at': data.get('created_at', now),
+                })
+
+                # Вставляем пачками, чтобы не держать все строки в памяти
+                if len(batch) >= self.MIGRATION_CHUNK_SIZE:
+                    session.bulk_insert_mappings(InstagramAccount, batch)
+                    migrated_count += len(batch)
+                    batch.clear()
+
+            if batch:
+                session.bulk_insert_mappings(InstagramAccount, batch)
+                migrated_count += len(batch)
+
             session.commit()
             session.close()
-            
+
+            self._invalidate_stats_cache()
             logger.info(f"Migrated {migrated_count} accounts from pickle file")
             return True
-            
+
         except Exception as e:
             logger.error(f"Migration failed: {e}")
             return False
     
-    def get_database_stats(self) -> Dict[str, Any]:
-        """Получение статистики базы данных"""
+    def _invalidate_stats_cache(self):
+        """Сбросить кэш статистики после изменения данных"""
+        self._stats_cache = None
+
+    def get_database_stats(self, force_refresh: bool = False) -> Dict[str, Any]:
+        """Получение статистики базы данных
+
+        Результат кэшируется на STATS_CACHE_TTL секунд, чтобы частый
+        опрос (дашборд, мониторинг) не бил по базе; force_refresh=True
+        пересчитывает немедленно.
+        """
+        if (not force_refresh and self._stats_cache is not None
+                and time.monotonic() - self._stats_cache_at < self.STATS_CACHE_TTL):
+            return self._stats_cache
+
         session = self.SessionLocal()
-        
+
         try:
+            # Агрегируем одним запросом на таблицу вместо отдельного COUNT
+            # на каждый статус/тип контента (9 запросов -> 3)
+            total_accounts, active_accounts = session.query(
+                func.count(InstagramAccount.id),
+                func.sum(case((InstagramAccount.is_active == True, 1), else_=0))
+            ).one()
+
+            status_counts = dict(
+                session.query(Publication.status, func.count(Publication.id))
+                .group_by(Publication.status).all()
+            )
+            content_counts = dict(
+                session.query(Publication.content_type, func.count(Publication.id))
+                .group_by(Publication.content_type).all()
+            )
+
             stats = {
                 'accounts': {
-                    'total': session.query(InstagramAccount).count(),
-                    'active': session.query(InstagramAccount).filter_by(is_active=True).count(),
+                    'total': total_accounts,
+                    'active': int(active_accounts or 0),
                 },
                 'publications': {
-                    'total': session.query(Publication).count(),
-                    'queued': session.query(Publication).filter_by(status='queued').count(),
-                    'published': session.query(Publication).filter_by(status='published').count(),
-                    'failed': session.query(Publication).filter_by(status='failed').count(),
+                    'total': sum(status_counts.values()),
+                    'queued': status_counts.get('queued', 0),
+                    'published': status_counts.get('published', 0),
+                    'failed': status_counts.get('failed', 0),
+                },
+                'content_types': {
+                    content_type: content_counts.get(content_type, 0)
+                    for content_type in ('post', 'story', 'reel')
                 },
-                'content_types': {},
-                'users': session.query(UserSettings).count()
+                'users': session.query(func.count(UserSettings.id)).scalar()
             }
-            
-            # Статистика по типам контента
-            for content_type in ['post', 'story', 'reel']:
-                stats['content_types'][content_type] = session.query(Publication).filter_by(
-                    content_type=content_type
-                ).count()
-            
+
+            self._stats_cache = stats
+            self._stats_cache_at = time.monotonic()
             return stats
             
         except Exception as e:
@@ -159,18 +277,24 @@ class DatabaseManager:
             session.close()
     
     def cleanup_old_data(self, days: int = 30) -> int:
-        """Очистка старых данных"""
+        """Очистка старых данных
+
+        На больших таблицах рассчитывает на индекс (status, created_at),
+        объявленный в модели Publication.
+        """
         session = self.SessionLocal()
         cutoff_date = datetime.utcnow() - timedelta(days=days)
-        
+
         try:
-            # Удаляем старые опубликованные/неудачные публикации
+            # Удаляем старые опубликованные/неудачные публикации одним
+            # серверным DELETE, без выборки строк в Python
             deleted_count = session.query(Publication).filter(
                 Publication.status.in_(['published', 'failed']),
                 Publication.created_at < cutoff_date
-            ).delete()
+            ).delete(synchronize_session=False)
             
             session.commit()
+            self._invalidate_stats_cache()
             logger.info(f"Cleaned up {deleted_count} old records")
             return deleted_count
             
@@ -193,12 +317,14 @@ class DatabaseManager:
                 count = result.scalar()
                 logger.info(f"Table {table}: {count} records")
             
-            # Проверяем ссылочную целостность
-            orphaned_publications = session.query(Publication).filter(
-                ~Publication.account_username.in_(
-                    session.query(InstagramAccount.username)
-                )
-            ).count()
+            # Проверяем ссылочную целостность: LEFT JOIN вместо NOT IN
+            # (подзапрос NOT IN не использует join-план и небезопасен к NULL)
+            orphaned_publications = session.query(
+                func.count(Publication.id)
+            ).outerjoin(
+                InstagramAccount,
+                Publication.account_username == InstagramAccount.username
+            ).filter(InstagramAccount.username.is_(None)).scalar()
             
             if orphaned_publications > 0:
                 logger.warning(f"Found {orphaned_publications} orphaned publications")
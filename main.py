@@ -4,23 +4,66 @@ import asyncio
 import json
 import re
 import hashlib
+import random
 import base64
 from datetime import datetime, timedelta
-from threading import Thread, Lock
+from threading import Thread, Event, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+import time
 from time import sleep
 from dataclasses import dataclass, asdict
 from typing import Optional, List, Dict, Any
-from functools import wraps
+from functools import wraps, lru_cache
 import pytz
+import requests
+
+# Часовые пояса создаются один раз на модуль: pytz.timezone() на каждом
+# сообщении — это лишний lock + поиск в олсон-базе
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+UTC = pytz.utc
+
+# Эмодзи для отображения типов контента и медиа — константы модуля,
+# чтобы не пересоздавать словари на каждый рендер очереди
+CONTENT_EMOJI = {"post": "📝", "story": "📸", "reel": "🎬"}
+MEDIA_EMOJI = {"photo": "🖼️", "video": "🎥"}
+DEFAULT_EMOJI = "📄"
+
+# Скомпилированный разбор ДД.ММ.ГГГГ ЧЧ:ММ — быстрее strptime,
+# который на каждом вызове заново проходит формат через _strptime
+TIME_INPUT_RE = re.compile(r'^(\d{2})\.(\d{2})\.(\d{4}) (\d{2}):(\d{2})$')
+
+# Отображаемые названия — константы модуля, а не словарь на каждый вызов
+CONTENT_NAMES = {"post": "поста", "story": "Story", "reel": "Reel"}
+
+# Потолок кэша дайджест -> media id загруженных файлов
+MEDIA_ID_CACHE_MAX = 1024
+
+# Потолок кэша file_unique_id -> путь скачанного файла
+DOWNLOADED_MEDIA_CACHE_MAX = 256
+TWO_FA_METHOD_BUTTONS = {
+    'app': '📱 Приложение',
+    'sms': '💬 SMS',
+    'whatsapp': '💚 WhatsApp',
+    'call': '📞 Звонок',
+    'email': '📧 Email'
+}
+TWO_FA_METHOD_GENITIVE = {
+    'app': 'приложения',
+    'sms': 'SMS',
+    'whatsapp': 'WhatsApp',
+    'call': 'звонка',
+    'email': 'email'
+}
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 import sqlite3
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, Float
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, Float, Index, func
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 
 from telegram import (
     Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
@@ -32,10 +75,73 @@ from telegram.ext import (
 )
 from instagrapi import Client
 from instagrapi.exceptions import (
-    LoginRequired, TwoFactorRequired, ChallengeRequired, 
-    ClientError, BadPassword, ReloginAttemptExceeded
+    LoginRequired, TwoFactorRequired, ChallengeRequired,
+    ClientError, BadPassword, ReloginAttemptExceeded,
+    PleaseWaitFewMinutes
 )
 
+# InlineKeyboardButton неизменяем — один экземпляр на метод,
+# вместо пересоздания кнопок при каждом 2FA-промпте
+TWO_FA_BUTTONS = {
+    method: InlineKeyboardButton(label, callback_data=f"2fa_method_{method}")
+    for method, label in TWO_FA_METHOD_BUTTONS.items()
+}
+
+
+@lru_cache(maxsize=None)
+def two_fa_keyboard(methods: tuple) -> InlineKeyboardMarkup:
+    """Клавиатура 2FA для набора методов.
+
+    Комбинаций методов максимум 32 — готовые разметки кэшируются,
+    повторный промпт обходится одним lookup без аллокаций.
+    """
+    keyboard = [[TWO_FA_BUTTONS[method]] for method in methods if method in TWO_FA_BUTTONS]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_account")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Главное меню статично — собираем разметку и тексты один раз,
+# а не при каждом /start и возврате в меню
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📱 Аккаунты", callback_data="menu_accounts"),
+        InlineKeyboardButton("📝 Добавить пост", callback_data="menu_add_post")
+    ],
+    [
+        InlineKeyboardButton("📸 Добавить Story", callback_data="menu_add_story"),
+        InlineKeyboardButton("🎬 Добавить Reel", callback_data="menu_add_reel")
+    ],
+    [
+        InlineKeyboardButton("📋 Очередь", callback_data="menu_queue"),
+        InlineKeyboardButton("📊 Статистика", callback_data="menu_stats")
+    ],
+    [
+        InlineKeyboardButton("⚙️ Настройки", callback_data="menu_settings"),
+        InlineKeyboardButton("❓ Помощь", callback_data="menu_help")
+    ]
+])
+
+START_TEXT = """
+🤖 <b>Enhanced Instagram Bot</b>
+
+Добро пожаловать! Этот бот поможет вам:
+
+📱 Управлять Instagram аккаунтами
+📝 Планировать посты с фото/видео
+📸 Публиковать Stories
+🎬 Создавать Reels
+📊 Отслеживать статистику
+⏰ Автоматически публиковать по расписанию
+
+Выберите действие:
+        """
+
+MAIN_MENU_TEXT = """
+🤖 <b>Enhanced Instagram Bot</b>
+
+Главное меню - выберите действие:
+        """
+
 # ==================== КОНФИГУРАЦИЯ ====================
 
 @dataclass
@@ -43,6 +149,7 @@ class BotConfig:
     telegram_token: str
     database_url: str = 'sqlite:///instagram_bot.db'
     temp_dir: str = 'tmp'
+    session_dir: str = 'sessions'
     scheduler_interval: int = 10
     max_retries: int = 3
     log_level: str = 'INFO'
@@ -73,7 +180,12 @@ class InstagramAccount(Base):
 
 class Publication(Base):
     __tablename__ = 'publications'
-    
+    __table_args__ = (
+        # Под выборки планировщика и чистку старых записей
+        Index('ix_publications_status_publish_time', 'status', 'publish_time'),
+        Index('ix_publications_status_created_at', 'status', 'created_at'),
+    )
+
     id = Column(Integer, primary_key=True)
     account_username = Column(String, nullable=False)
     content_type = Column(String, nullable=False)  # post, story, reel
@@ -112,30 +224,71 @@ class UserSettings(Base):
 
 # ==================== БЕЗОПАСНОСТЬ ====================
 
+@lru_cache(maxsize=1)
+def _derive_key(password: bytes, salt: bytes) -> bytes:
+    """Вывод ключа из пароля: 100k итераций PBKDF2 считаем один раз на процесс."""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=100000,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password))
+
+
 class SecurityManager:
+    # Случайный мастер-ключ AES-GCM хранится в файле рядом с ботом;
+    # PBKDF2-медлительность не нужна, когда ключ не выводится из пароля
+    KEY_FILE = 'encryption.key'
+    GCM_PREFIX = 'gcm:'
+
     def __init__(self, password: str):
         self.password = password.encode()
-        self._key = None
-    
-    def _get_key(self) -> bytes:
-        if self._key is None:
-            salt = b'instagram_bot_salt'
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,
-                salt=salt,
-                iterations=100000,
+        self._fernet = None
+        self._aes = AESGCM(self._load_or_create_key())
+
+    def _load_or_create_key(self) -> bytes:
+        if not os.path.exists(self.KEY_FILE):
+            key = AESGCM.generate_key(bit_length=256)
+            # O_EXCL + mode 0600 при создании: файл ни на мгновение не
+            # читается другими пользователями и не перетирает ключ,
+            # записанный параллельным стартом
+            try:
+                fd = os.open(self.KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(key)
+                return key
+            except FileExistsError:
+                # Гонку выиграл параллельный процесс — читаем его ключ
+                pass
+
+        with open(self.KEY_FILE, 'rb') as f:
+            key = f.read()
+        if len(key) != 32:
+            raise SecurityError(
+                f"Key file {self.KEY_FILE} is corrupt: "
+                f"expected 32 bytes, got {len(key)}"
             )
-            self._key = base64.urlsafe_b64encode(kdf.derive(self.password))
-        return self._key
-    
+        return key
+
+    def _get_fernet(self) -> Fernet:
+        # Fernet-ключ из пароля нужен только для записей,
+        # зашифрованных до перехода на AES-GCM
+        if self._fernet is None:
+            self._fernet = Fernet(_derive_key(self.password, b'instagram_bot_salt'))
+        return self._fernet
+
     def encrypt(self, data: str) -> str:
-        f = Fernet(self._get_key())
-        return f.encrypt(data.encode()).decode()
-    
+        nonce = os.urandom(12)
+        ciphertext = self._aes.encrypt(nonce, data.encode(), None)
+        return self.GCM_PREFIX + base64.b64encode(nonce + ciphertext).decode()
+
     def decrypt(self, encrypted_data: str) -> str:
-        f = Fernet(self._get_key())
-        return f.decrypt(encrypted_data.encode()).decode()
+        if encrypted_data.startswith(self.GCM_PREFIX):
+            raw = base64.b64decode(encrypted_data[len(self.GCM_PREFIX):])
+            return self._aes.decrypt(raw[:12], raw[12:], None).decode()
+        # Старый формат: Fernet поверх PBKDF2-ключа
+        return self._get_fernet().decrypt(encrypted_data.encode()).decode()
     
     def hash_password(self, password: str) -> str:
         return hashlib.sha256(password.encode()).hexdigest()
@@ -215,7 +368,7 @@ class ValidationError(InstagramBotError):
     SELECT_CONTENT_TYPE, SELECT_MEDIA_TYPE, UPLOAD_MEDIA,
     INPUT_REEL_CAPTION, INPUT_REEL_TIME, SETTINGS_MENU,
     EDIT_NOTIFICATIONS, EDIT_TIMEZONE
-) = range(16)
+) = range(17)
 
 # ==================== ОСНОВНОЙ КЛАСС БОТА ====================
 
@@ -223,8 +376,45 @@ class EnhancedInstagramBot:
     def __init__(self, config: BotConfig):
         self.config = config
         self.security = SecurityManager(config.encryption_password)
-        self.account_lock = Lock()
         self.scheduler_running = False
+        # Будит планировщик при постановке новой публикации, чтобы
+        # более ранний publish_time не ждал конца текущего сна
+        self._scheduler_wake = Event()
+
+        # Дайджест файла -> media id уже загруженного в Instagram контента
+        self._media_id_cache: Dict[str, str] = {}
+        self._client_cache: Dict[str, Client] = {}
+        # file_unique_id Telegram -> путь уже скачанного файла
+        self._downloaded_media_cache: Dict[str, str] = {}
+
+        # Клавиатуры выбора аккаунта, инвалидируются при изменении аккаунтов
+        self._account_keyboard_cache: Dict[str, InlineKeyboardMarkup] = {}
+
+        # Учетные данные добавляемого аккаунта (user_id -> dict).
+        # Держим их только в памяти процесса, а не в context.user_data:
+        # при включенной persistence PTB пишет user_data на диск,
+        # и пароль в открытом виде оказался бы в файле
+        self._pending_credentials: Dict[int, dict] = {}
+
+        # По одному однопоточному executor'у на аккаунт: публикации
+        # разных аккаунтов идут параллельно, внутри аккаунта — по порядку
+        self._account_executors: Dict[str, ThreadPoolExecutor] = {}
+
+        # Бэкофф по аккаунтам после ошибок Instagram: до этого времени
+        # планировщик не трогает публикации аккаунта
+        self._backoff_until: Dict[str, datetime] = {}
+
+        # Ограничитель одновременных логинов в Instagram: наплыв
+        # /add_account не должен открывать N сессий сразу
+        self._login_semaphore = BoundedSemaphore(4)
+
+        # Диспетчеризация по типу контента резолвится один раз,
+        # а не через цепочку строковых сравнений на каждом тике
+        self._publishers = {
+            'post': self.publish_post,
+            'story': self.publish_story,
+            'reel': self.publish_reel,
+        }
         
         # Настройка логирования
         self._setup_logging()
@@ -232,13 +422,26 @@ class EnhancedInstagramBot:
         # Инициализация базы данных
         self.engine = create_engine(config.database_url)
         Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.db_session = Session()
-        
-        # Создание временной директории
-        if not os.path.exists(config.temp_dir):
-            os.makedirs(config.temp_dir)
+        # Сессия SQLAlchemy не потокобезопасна, а к БД ходят воркеры
+        # диспетчера, планировщик и пулы публикаций: scoped_session
+        # выдает каждому потоку собственную thread-local сессию
+        session_factory = sessionmaker(bind=self.engine)
+        self.db_session = scoped_session(session_factory)
+
+        # Публикации, зависшие в 'publishing' после аварийного
+        # завершения, возвращаются в очередь
+        self.db_session.query(Publication).filter(
+            Publication.status == 'publishing'
+        ).update({'status': 'queued'}, synchronize_session=False)
+        self.db_session.commit()
         
+        # Создание временной директории и директории сессий Instagram
+        os.makedirs(config.temp_dir, exist_ok=True)
+        os.makedirs(config.session_dir, exist_ok=True)
+
+        # Подчищаем файлы, оставшиеся от прошлых запусков
+        self._sweep_temp_dir()
+
         self.logger.info("Bot initialized successfully")
 
     def _setup_logging(self):
@@ -254,46 +457,82 @@ class EnhancedInstagramBot:
 
     # ==================== УПРАВЛЕНИЕ АККАУНТАМИ ====================
 
+    def _session_settings_path(self, username: str) -> str:
+        return os.path.join(self.config.session_dir, f"{username}.json")
+
     @retry(max_attempts=3)
-    def init_instagram_client(self, username: str, password: str, 
-                             verification_code: str = None, 
+    def init_instagram_client(self, username: str, password: str,
+                             verification_code: str = None,
                              verification_method: str = None) -> Client:
         """Инициализация Instagram клиента с обработкой 2FA"""
         cl = Client()
+        settings_path = self._session_settings_path(username)
+
+        # Переиспользуем сохраненную сессию: login с загруженными
+        # cookies — один round-trip вместо полного handshake
+        if not verification_code and os.path.exists(settings_path):
+            try:
+                cl.load_settings(settings_path)
+                with self._login_semaphore:
+                    cl.login(username, password)
+                    cl.get_timeline_feed()
+                return cl
+            except Exception as e:
+                self.logger.warning(f"Saved session for {username} is stale, relogin: {e}")
+                cl = Client()
+
         try:
-            if verification_code and verification_method:
-                if verification_method == 'email':
-                    cl.login(username, password, verification_code=verification_code)
+            with self._login_semaphore:
+                if verification_code and verification_method:
+                    if verification_method == 'email':
+                        cl.login(username, password, verification_code=verification_code)
+                    else:
+                        cl.login(username, password)
+                        if hasattr(cl, 'challenge_code_handler'):
+                            cl.challenge_code_handler(username, password)
                 else:
                     cl.login(username, password)
-                    if hasattr(cl, 'challenge_code_handler'):
-                        cl.challenge_code_handler(username, password)
-            else:
-                cl.login(username, password)
+
+            try:
+                cl.dump_settings(settings_path)
+            except Exception as e:
+                self.logger.warning(f"Failed to save session for {username}: {e}")
+
             return cl
         except Exception as e:
             self.logger.error(f"Login error for {username}: {e}")
             raise
 
-    def get_2fa_methods(self, username: str, password: str) -> List[str]:
-        """Получение доступных методов 2FA"""
+    def probe_login(self, username: str, password: str) -> tuple:
+        """Пробный вход: (клиент, методы 2FA).
+
+        При успешном входе возвращает залогиненный клиент и пустой
+        список — add_account переиспользует клиента вместо второго
+        handshake. При требовании 2FA клиента нет, зато есть методы.
+        """
         cl = Client()
         try:
-            cl.login(username, password)
-            return []
+            with self._login_semaphore:
+                cl.login(username, password)
+            try:
+                cl.dump_settings(self._session_settings_path(username))
+            except Exception as e:
+                self.logger.warning(f"Failed to save probe session for {username}: {e}")
+            return cl, []
         except TwoFactorRequired as e:
-            return getattr(e, 'allowed_methods', ['app', 'sms', 'whatsapp', 'call', 'email'])
+            return None, getattr(e, 'allowed_methods', ['app', 'sms', 'whatsapp', 'call', 'email'])
         except Exception as e:
             self.logger.error(f"2FA check error: {e}")
-            return []
+            return None, []
 
-    def add_account(self, username: str, password: str, 
-                   verification_code: str = None, 
-                   verification_method: str = None) -> bool:
+    def add_account(self, username: str, password: str,
+                   verification_code: str = None,
+                   verification_method: str = None,
+                   client: Client = None) -> bool:
         """Добавление Instagram аккаунта"""
         try:
-            cl = self.init_instagram_client(username, password, 
-                                          verification_code, verification_method)
+            cl = client or self.init_instagram_client(username, password,
+                                                      verification_code, verification_method)
             
             encrypted_password = self.security.encrypt(password)
             
@@ -319,6 +558,8 @@ class EnhancedInstagramBot:
                 self.db_session.add(account)
             
             self.db_session.commit()
+            self._client_cache[username] = cl
+            self._account_keyboard_cache.clear()
             self.logger.info(f"Account {username} added successfully")
             return True
             
@@ -335,17 +576,34 @@ class EnhancedInstagramBot:
         
         if not account:
             raise AccountNotFoundError(f"Account {username} not found")
-        
+
+        # Залогиненный клиент переиспользуется между публикациями,
+        # чтобы планировщик не проходил полный login на каждом тике
+        cl = self._client_cache.get(username)
+        if cl is not None:
+            # last_used — чисто учетное поле; коммитим не чаще раза в
+            # минуту, чтобы не платить fsync на каждую публикацию
+            now = datetime.utcnow()
+            if account.last_used is None or (now - account.last_used).total_seconds() >= 60:
+                account.last_used = now
+                self.db_session.commit()
+            return cl
+
         try:
             password = self.security.decrypt(account.encrypted_password)
             cl = self.init_instagram_client(username, password)
-            
+            self._client_cache[username] = cl
+
             # Обновляем время последнего использования
             account.last_used = datetime.utcnow()
             self.db_session.commit()
-            
+
             return cl
         except Exception as e:
+            self._client_cache.pop(username, None)
+            # Неудачный логин бэкоффит аккаунт так же, как неудачная
+            # публикация: здесь известно настоящее исключение Instagram
+            self._register_publish_failure(username, e)
             self.logger.error(f"Failed to get client for {username}: {e}")
             return None
 
@@ -372,6 +630,74 @@ class EnhancedInstagramBot:
         # В реальной реализации используйте ffprobe или moviepy
         return 30.0  # Заглушка
 
+    @staticmethod
+    def _download_file_streamed(file_obj, file_path: str):
+        """Потоковое скачивание файла Telegram на диск.
+
+        File.download() в v13 сначала вычитывает весь файл в память и
+        только потом пишет на диск; для больших видео это удваивает
+        пиковый RSS. Стримим из CDN мегабайтными кусками напрямую в файл.
+        """
+        response = requests.get(file_obj.file_path, stream=True, timeout=60)
+        response.raise_for_status()
+        with open(file_path, 'wb', buffering=1 << 20) as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+
+    def _cleanup_media_files(self, media_paths: List[str]):
+        """Удаление загруженных медиафайлов после успешной публикации"""
+        for path in media_paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.warning(f"Failed to remove {path}: {e}")
+
+    def _sweep_temp_dir(self, max_age_seconds: int = 86400):
+        """Удаление устаревших файлов из temp_dir при старте"""
+        cutoff = time.time() - max_age_seconds
+
+        # Файлы ещё не опубликованных публикаций трогать нельзя,
+        # даже если они старше порога
+        referenced = set()
+        for (paths_json,) in self.db_session.query(Publication.media_paths).filter(
+            Publication.status == 'queued'
+        ):
+            try:
+                referenced.update(json.loads(paths_json))
+            except (TypeError, ValueError):
+                continue
+
+        try:
+            entries = os.listdir(self.config.temp_dir)
+        except OSError:
+            return
+        for name in entries:
+            path = os.path.join(self.config.temp_dir, name)
+            if path in referenced:
+                continue
+            try:
+                if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except OSError:
+                continue
+
+    @staticmethod
+    def get_media_digest(file_path: str) -> str:
+        """BLAKE2b-дайджест медиафайла (ключ кэша загрузок)"""
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _remember_media_id(self, digest: str, media_id: str):
+        """Запись в кэш загрузок с вытеснением самых старых дайджестов"""
+        self._media_id_cache[digest] = media_id
+        while len(self._media_id_cache) > MEDIA_ID_CACHE_MAX:
+            self._media_id_cache.pop(next(iter(self._media_id_cache)))
+
     # ==================== ПУБЛИКАЦИЯ КОНТЕНТА ====================
 
     @retry(max_attempts=3)
@@ -382,10 +708,29 @@ class EnhancedInstagramBot:
             if not cl:
                 publication.status = 'failed'
                 publication.error_message = 'Failed to get Instagram client'
+                # Без commit статус 'publishing' переживет rollback при
+                # закрытии сессии воркера, и публикация зависнет навсегда
+                self.db_session.commit()
                 return False
 
             media_paths = json.loads(publication.media_paths)
-            
+
+            # Дайджест каждого файла считаем один раз и переиспользуем
+            # после загрузки: повторное чтение 50-МБ видео ради того же
+            # хэша — лишние дисковые мегабайты
+            digests = {path: self.get_media_digest(path) for path in media_paths}
+
+            # Предупреждаем о байт-в-байт дубликатах уже загруженных файлов
+            # (повторная загрузка того же контента — лишний трафик и риск
+            # антиспам-санкций Instagram)
+            for path, digest in digests.items():
+                cached_media_id = self._media_id_cache.get(digest)
+                if cached_media_id:
+                    self.logger.warning(
+                        f"Media {path} was already uploaded as {cached_media_id}, "
+                        f"re-uploading duplicate content"
+                    )
+
             if publication.media_type == 'photo':
                 if len(media_paths) == 1:
                     # Одиночное фото
@@ -403,7 +748,12 @@ class EnhancedInstagramBot:
             
             publication.status = 'published'
             publication.published_at = datetime.utcnow()
-            
+
+            # Запоминаем дайджесты загруженных файлов
+            media_id = str(getattr(media, 'pk', '')) or 'unknown'
+            for digest in digests.values():
+                self._remember_media_id(digest, media_id)
+
             # Обновляем счетчики
             account = self.db_session.query(InstagramAccount).filter_by(
                 username=publication.account_username
@@ -412,12 +762,15 @@ class EnhancedInstagramBot:
                 account.posts_count += 1
             
             self.db_session.commit()
+            self._cleanup_media_files(media_paths)
             self.logger.info(f"Post published successfully for {publication.account_username}")
             return True
             
         except Exception as e:
             publication.status = 'failed'
             publication.error_message = str(e)
+            self._client_cache.pop(publication.account_username, None)
+            self._register_publish_failure(publication.account_username, e)
             self.db_session.commit()
             self.logger.error(f"Post publish error: {e}")
             return False
@@ -430,15 +783,23 @@ class EnhancedInstagramBot:
             if not cl:
                 publication.status = 'failed'
                 publication.error_message = 'Failed to get Instagram client'
+                # Без commit статус 'publishing' переживет rollback при
+                # закрытии сессии воркера, и публикация зависнет навсегда
+                self.db_session.commit()
                 return False
 
             media_paths = json.loads(publication.media_paths)
-            
-            for media_path in media_paths:
-                if publication.media_type == 'photo':
-                    cl.photo_upload_to_story(media_path)
-                elif publication.media_type == 'video':
-                    cl.video_upload_to_story(media_path)
+
+            if publication.media_type == 'photo':
+                upload = cl.photo_upload_to_story
+            else:
+                upload = cl.video_upload_to_story
+
+            # Кадры грузим последовательно: клиент instagrapi (и его
+            # requests.Session) не потокобезопасен, и воркер аккаунта
+            # намеренно один, чтобы загрузки аккаунта не шли параллельно
+            for path in media_paths:
+                upload(path)
             
             publication.status = 'published'
             publication.published_at = datetime.utcnow()
@@ -451,12 +812,15 @@ class EnhancedInstagramBot:
                 account.stories_count += 1
             
             self.db_session.commit()
+            self._cleanup_media_files(media_paths)
             self.logger.info(f"Story published successfully for {publication.account_username}")
             return True
             
         except Exception as e:
             publication.status = 'failed'
             publication.error_message = str(e)
+            self._client_cache.pop(publication.account_username, None)
+            self._register_publish_failure(publication.account_username, e)
             self.db_session.commit()
             self.logger.error(f"Story publish error: {e}")
             return False
@@ -469,6 +833,9 @@ class EnhancedInstagramBot:
             if not cl:
                 publication.status = 'failed'
                 publication.error_message = 'Failed to get Instagram client'
+                # Без commit статус 'publishing' переживет rollback при
+                # закрытии сессии воркера, и публикация зависнет навсегда
+                self.db_session.commit()
                 return False
 
             media_paths = json.loads(publication.media_paths)
@@ -492,12 +859,15 @@ class EnhancedInstagramBot:
                 account.reels_count += 1
             
             self.db_session.commit()
+            self._cleanup_media_files(media_paths)
             self.logger.info(f"Reel published successfully for {publication.account_username}")
             return True
             
         except Exception as e:
             publication.status = 'failed'
             publication.error_message = str(e)
+            self._client_cache.pop(publication.account_username, None)
+            self._register_publish_failure(publication.account_username, e)
             self.db_session.commit()
             self.logger.error(f"Reel publish error: {e}")
             return False
@@ -512,18 +882,97 @@ class EnhancedInstagramBot:
             content_type=content_type,
             media_type=media_type,
             media_paths=json.dumps(media_paths),
-            caption=caption,
+            caption=caption or '',
             publish_time=publish_time or datetime.utcnow(),
             status='queued'
         )
         
         self.db_session.add(publication)
         self.db_session.commit()
-        
+
+        self._scheduler_wake.set()
+
         return publication
 
+    def cancel_publication(self, publication_id: int) -> bool:
+        """Отмена запланированной публикации.
+
+        Условие status == 'queued' входит в сам UPDATE, поэтому отмена
+        атомарна относительно планировщика: публикация, которую он уже
+        забрал в работу, не будет помечена отмененной задним числом.
+        """
+        updated = self.db_session.query(Publication).filter(
+            Publication.id == publication_id,
+            Publication.status == 'queued'
+        ).update({'status': 'cancelled'}, synchronize_session=False)
+        self.db_session.commit()
+        return bool(updated)
+
     # ==================== ПЛАНИРОВЩИК ====================
 
+    def _account_executor(self, username: str) -> ThreadPoolExecutor:
+        """Однопоточный executor публикаций для аккаунта"""
+        executor = self._account_executors.get(username)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=f"publish-{username}"
+            )
+            self._account_executors[username] = executor
+        return executor
+
+    def _register_publish_failure(self, username: str, exc: Exception):
+        """Бэкофф аккаунта в зависимости от типа ошибки Instagram.
+
+        PleaseWaitFewMinutes — это прямой rate-limit, долбить дальше
+        значит усугублять; ChallengeRequired без ручного вмешательства
+        не разрешится; прочие ClientError — короткая пауза с джиттером.
+        """
+        if isinstance(exc, PleaseWaitFewMinutes):
+            delay = 300.0
+        elif isinstance(exc, ChallengeRequired):
+            delay = 1800.0
+        elif isinstance(exc, ClientError):
+            delay = 60.0 + random.uniform(0, 30)
+        else:
+            return
+
+        self._backoff_until[username] = datetime.utcnow() + timedelta(seconds=delay)
+        self.logger.warning(
+            f"Account {username} backed off for {delay:.0f}s after {type(exc).__name__}"
+        )
+
+    def _publish_and_notify(self, pub_id: int):
+        """Публикация и уведомление — выполняется в пуле аккаунта.
+
+        Воркер не трогает ORM-объекты, загруженные потоком планировщика:
+        ему передается только id, а публикация перечитывается в
+        собственной (thread-local) сессии воркера.
+        """
+        pub = None
+        try:
+            pub = self.db_session.query(Publication).get(pub_id)
+            if pub is None:
+                return
+
+            publish = self._publishers.get(pub.content_type)
+            if publish is not None:
+                publish(pub)
+
+            # Отправляем уведомление о публикации
+            self.send_publish_notification(pub)
+
+        except Exception as e:
+            self.logger.error(f"Publication error: {e}")
+            if pub is not None:
+                self._register_publish_failure(pub.account_username, e)
+                pub.status = 'failed'
+                pub.error_message = str(e)
+                self.db_session.commit()
+        finally:
+            # Закрываем thread-local сессию, возвращая соединение в пул
+            self.db_session.remove()
+
     def scheduler(self):
         """Планировщик публикаций"""
         self.scheduler_running = True
@@ -532,32 +981,68 @@ class EnhancedInstagramBot:
             try:
                 current_time = datetime.utcnow()
                 
-                # Получаем все публикации, готовые к отправке
+                # Получаем все публикации, готовые к отправке: по индексу
+                # (status, publish_time) и в порядке наступления времени,
+                # без полного прохода по таблице
                 publications = self.db_session.query(Publication).filter(
                     Publication.status == 'queued',
                     Publication.publish_time <= current_time
-                ).all()
+                ).order_by(Publication.publish_time).all()
                 
+                # Аккаунты в бэкоффе пропускаем: их публикации остаются
+                # queued и будут взяты после окончания паузы
+                ready = []
                 for pub in publications:
-                    try:
-                        if pub.content_type == 'post':
-                            self.publish_post(pub)
-                        elif pub.content_type == 'story':
-                            self.publish_story(pub)
-                        elif pub.content_type == 'reel':
-                            self.publish_reel(pub)
-                        
-                        # Отправляем уведомление о публикации
-                        self.send_publish_notification(pub)
-                        
-                    except Exception as e:
-                        self.logger.error(f"Publication error: {e}")
-                        pub.status = 'failed'
-                        pub.error_message = str(e)
-                        self.db_session.commit()
-                
-                sleep(self.config.scheduler_interval)
+                    backoff = self._backoff_until.get(pub.account_username)
+                    if backoff and backoff > current_time:
+                        continue
+                    ready.append(pub)
+
+                if ready:
+                    # Забираем публикации guarded UPDATE'ом (симметрично
+                    # cancel_publication): отмена, успевшая между нашим
+                    # SELECT и commit, не будет молча перетерта, а
+                    # следующий тик не возьмет уже забранные строки.
+                    # Воркерам уходят только id — свои ORM-объекты они
+                    # перечитают в собственных сессиях
+                    claimed = []
+                    for pub in ready:
+                        updated = self.db_session.query(Publication).filter(
+                            Publication.id == pub.id,
+                            Publication.status == 'queued'
+                        ).update({'status': 'publishing'}, synchronize_session=False)
+                        if updated:
+                            claimed.append((pub.id, pub.account_username))
+                    self.db_session.commit()
+
+                    # Разные аккаунты публикуются параллельно; внутри
+                    # одного аккаунта — последовательно (воркер пула = 1),
+                    # чтобы не дергать антиспам Instagram
+                    for pub_id, username in claimed:
+                        executor = self._account_executor(username)
+                        executor.submit(self._publish_and_notify, pub_id)
                 
+                # Спим ровно до ближайшей запланированной публикации
+                # вместо слепого тика раз в interval секунд: пустая
+                # очередь не будит поток чаще базового интервала, а
+                # близкая публикация не ждет лишние секунды
+                next_due = self.db_session.query(
+                    func.min(Publication.publish_time)
+                ).filter(Publication.status == 'queued').scalar()
+
+                timeout = self.config.scheduler_interval
+                if next_due is not None:
+                    until_due = (next_due - datetime.utcnow()).total_seconds()
+                    # Просроченные, но пропущенные из-за бэкоффа записи
+                    # не должны крутить цикл впустую — для них базовый интервал
+                    if until_due > 0:
+                        timeout = min(timeout, max(0.5, until_due))
+
+                # wait вместо sleep: add_to_queue будит поток сразу,
+                # если появилась публикация с более ранним временем
+                if self._scheduler_wake.wait(timeout):
+                    self._scheduler_wake.clear()
+
             except Exception as e:
                 self.logger.error(f"Scheduler error: {e}")
                 sleep(30)
@@ -585,9 +1070,9 @@ class EnhancedInstagramBot:
         reels_published = len([p for p in publications if p.content_type == 'reel' and p.status == 'published'])
         failed_publications = len([p for p in publications if p.status == 'failed'])
         
-        active_accounts = self.db_session.query(InstagramAccount).filter(
-            InstagramAccount.is_active == True
-        ).count()
+        active_accounts = self.db_session.query(
+            func.count(InstagramAccount.id)
+        ).filter(InstagramAccount.is_active == True).scalar()
         
         report = f"""
 📊 <b>Отчет за неделю</b>
@@ -609,46 +1094,10 @@ class EnhancedInstagramBot:
     @check_user_access()
     def start(self, update: Update, context: CallbackContext):
         """Обработчик команды /start"""
-        keyboard = [
-            [
-                InlineKeyboardButton("📱 Аккаунты", callback_data="menu_accounts"),
-                InlineKeyboardButton("📝 Добавить пост", callback_data="menu_add_post")
-            ],
-            [
-                InlineKeyboardButton("📸 Добавить Story", callback_data="menu_add_story"),
-                InlineKeyboardButton("🎬 Добавить Reel", callback_data="menu_add_reel")
-            ],
-            [
-                InlineKeyboardButton("📋 Очередь", callback_data="menu_queue"),
-                InlineKeyboardButton("📊 Статистика", callback_data="menu_stats")
-            ],
-            [
-                InlineKeyboardButton("⚙️ Настройки", callback_data="menu_settings"),
-                InlineKeyboardButton("❓ Помощь", callback_data="menu_help")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        welcome_text = """
-🤖 <b>Enhanced Instagram Bot</b>
-
-Добро пожаловать! Этот бот поможет вам:
-
-📱 Управлять Instagram аккаунтами
-📝 Планировать посты с фото/видео
-📸 Публиковать Stories
-🎬 Создавать Reels
-📊 Отслеживать статистику
-⏰ Автоматически публиковать по расписанию
-
-Выберите действие:
-        """
-        
         update.message.reply_text(
-            welcome_text,
+            START_TEXT,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=MAIN_MENU_MARKUP
         )
 
     def callback_query_handler(self, update: Update, context: CallbackContext):
@@ -719,37 +1168,92 @@ class EnhancedInstagramBot:
         if not publications:
             text = "📋 Очередь публикаций пуста"
         else:
-            text = "<b>📋 Очередь публикаций:</b>\n\n"
-            
+            # Собираем через список + join: O(n) вместо квадратичной
+            # конкатенации строк на длинных очередях
+            parts = ["<b>📋 Очередь публикаций:</b>\n"]
+
             for pub in publications:
                 status_emoji = "⏳" if pub.status == 'queued' else "❌"
-                content_emoji = {"post": "📝", "story": "📸", "reel": "🎬"}.get(pub.content_type, "📄")
-                media_emoji = {"photo": "🖼️", "video": "🎥"}.get(pub.media_type, "📄")
-                
-                time_str = pub.publish_time.strftime('%d.%m.%Y %H:%M')
-                text += f"{status_emoji} {content_emoji} {media_emoji} <b>{pub.account_username}</b>\n"
-                text += f"📅 {time_str}\n"
-                
+                content_emoji = CONTENT_EMOJI.get(pub.content_type, DEFAULT_EMOJI)
+                media_emoji = MEDIA_EMOJI.get(pub.media_type, DEFAULT_EMOJI)
+
+                # Время в БД хранится в UTC — показываем московское,
+                # как и в подтверждении при постановке в очередь
+                display_time = pub.publish_time.replace(tzinfo=UTC).astimezone(MOSCOW_TZ)
+                time_str = display_time.strftime('%d.%m.%Y %H:%M')
+                parts.append(f"{status_emoji} {content_emoji} {media_emoji} <b>{pub.account_username}</b> (#{pub.id})")
+                parts.append(f"📅 {time_str}")
+
                 if pub.caption:
                     caption_preview = pub.caption[:50] + "..." if len(pub.caption) > 50 else pub.caption
-                    text += f"💬 {caption_preview}\n"
-                
+                    parts.append(f"💬 {caption_preview}")
+
                 if pub.status == 'failed' and pub.error_message:
-                    text += f"❌ {pub.error_message[:50]}...\n"
-                
-                text += "\n"
-        
+                    parts.append(f"❌ {pub.error_message[:50]}...")
+
+                parts.append("")
+
+            text = "\n".join(parts)
+
+        # Кнопка отмены для каждой ожидающей публикации
         keyboard = [
-            [InlineKeyboardButton("🔄 Обновить", callback_data="menu_queue")],
-            [InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]
+            [InlineKeyboardButton(f"🚫 Отменить #{pub.id}", callback_data=f"cancel_pub_{pub.id}")]
+            for pub in publications if pub.status == 'queued'
         ]
-        
+        keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="menu_queue")])
+        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
+
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
+
+        # Telegram ограничивает сообщение 4096 символами: длинный текст
+        # режем по границам строк и досылаем отдельными сообщениями,
+        # клавиатура остается на первом (редактируемом) сообщении
+        if len(text) > 4000:
+            pages = []
+            buf: List[str] = []
+            size = 0
+            for line in text.split('\n'):
+                if size + len(line) + 1 > 4000 and buf:
+                    pages.append('\n'.join(buf))
+                    buf = []
+                    size = 0
+                buf.append(line)
+                size += len(line) + 1
+            if buf:
+                pages.append('\n'.join(buf))
+        else:
+            pages = [text]
+
         if update.callback_query:
             update.callback_query.edit_message_text(
-                text, parse_mode=ParseMode.HTML, reply_markup=reply_markup
+                pages[0], parse_mode=ParseMode.HTML, reply_markup=reply_markup
             )
+            for page in pages[1:]:
+                update.callback_query.message.reply_text(page, parse_mode=ParseMode.HTML)
+        else:
+            update.message.reply_text(
+                pages[0], parse_mode=ParseMode.HTML, reply_markup=reply_markup
+            )
+            for page in pages[1:]:
+                update.message.reply_text(page, parse_mode=ParseMode.HTML)
+
+    def handle_cancel_publication(self, update: Update, context: CallbackContext):
+        """Отмена публикации кнопкой из очереди"""
+        query = update.callback_query
+        publication_id = int(query.data.rsplit('_', 1)[-1])
+
+        if self.cancel_publication(publication_id):
+            query.answer("🚫 Публикация отменена")
+        else:
+            # Планировщик успел забрать публикацию или она уже отменена
+            query.answer("⚠️ Публикацию уже нельзя отменить")
+
+        # Перерисовываем очередь; если она не изменилась, Telegram
+        # отвергает edit с тем же текстом — это не ошибка
+        try:
+            self.show_queue(update, context)
+        except Exception:
+            pass
 
     def show_statistics(self, update: Update, context: CallbackContext):
         """Показать статистику"""
@@ -771,7 +1275,9 @@ class EnhancedInstagramBot:
         
         failed_total = len([p for p in publications if p.status == 'failed'])
         
-        active_accounts = self.db_session.query(InstagramAccount).filter_by(is_active=True).count()
+        active_accounts = self.db_session.query(
+            func.count(InstagramAccount.id)
+        ).filter_by(is_active=True).scalar()
         
         text = f"""
 <b>📊 Статистика за 30 дней</b>
@@ -880,32 +1386,37 @@ class EnhancedInstagramBot:
 
     def start_add_content(self, update: Update, context: CallbackContext, content_type: str):
         """Начало процесса добавления контента"""
-        accounts = self.db_session.query(InstagramAccount).filter_by(is_active=True).all()
-        
-        if not accounts:
-            update.callback_query.edit_message_text(
-                "❌ Нет добавленных аккаунтов. Сначала добавьте аккаунт.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("➕ Добавить аккаунт", callback_data="add_account"),
-                    InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-                ]])
-            )
-            return
+        # Клавиатура выбора аккаунта собирается заново только после
+        # изменения списка аккаунтов, а не на каждое нажатие
+        reply_markup = self._account_keyboard_cache.get(content_type)
+
+        if reply_markup is None:
+            accounts = self.db_session.query(InstagramAccount).filter_by(is_active=True).all()
+
+            if not accounts:
+                update.callback_query.edit_message_text(
+                    "❌ Нет добавленных аккаунтов. Сначала добавьте аккаунт.",
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("➕ Добавить аккаунт", callback_data="add_account"),
+                        InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
+                    ]])
+                )
+                return
+
+            keyboard = []
+            for account in accounts:
+                keyboard.append([InlineKeyboardButton(
+                    f"👤 {account.username}",
+                    callback_data=f"select_account_{content_type}_{account.username}"
+                )])
+
+            keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            self._account_keyboard_cache[content_type] = reply_markup
 
-        keyboard = []
-        for account in accounts:
-            keyboard.append([InlineKeyboardButton(
-                f"👤 {account.username}", 
-                callback_data=f"select_account_{content_type}_{account.username}"
-            )])
-        
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
-        
-        content_names = {"post": "поста", "story": "Story", "reel": "Reel"}
-        
         update.callback_query.edit_message_text(
-            f"📱 Выберите аккаунт для {content_names[content_type]}:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            f"📱 Выберите аккаунт для {CONTENT_NAMES[content_type]}:",
+            reply_markup=reply_markup
         )
         
         context.user_data['content_type'] = content_type
@@ -972,7 +1483,7 @@ class EnhancedInstagramBot:
         context.user_data['uploaded_media'] = []
         
         media_emoji = "🖼️" if media_type == 'photo' else "🎥"
-        content_emoji = {"post": "📝", "story": "📸", "reel": "🎬"}.get(content_type, "📄")
+        content_emoji = CONTENT_EMOJI.get(content_type, DEFAULT_EMOJI)
         
         if content_type == 'reel':
             text = f"{content_emoji} Отправьте видео для Reel\n\n⚠️ Требования:\n• Максимум {self.config.media.max_reel_duration} секунд\n• Форматы: MP4, MOV\n• Размер до {self.config.media.max_file_size // (1024*1024)}MB"
@@ -1027,13 +1538,26 @@ class EnhancedInstagramBot:
             update.message.reply_text(f"❌ Неподдерживаемый формат. Разрешены: {', '.join(allowed_formats)}")
             return
         
-        # Скачиваем файл
+        # Скачиваем файл на диск. Держать байты в памяти (BytesIO) до
+        # публикации нельзя: очередь хранится в БД и переживает рестарт
+        # процесса, поэтому медиа обязаны лежать в temp_dir до publish_*
         try:
             timestamp = int(datetime.utcnow().timestamp())
             filename = f"{content_type}_{timestamp}_{len(context.user_data['uploaded_media'])}.{extension}"
             file_path = os.path.join(self.config.media.temp_dir, filename)
-            
-            file_obj.download(custom_path=file_path)
+
+            # Повторно присланный файл не качаем из CDN заново: по
+            # file_unique_id линкуем уже скачанную копию (hardlink имеет
+            # свое имя, так что удаление после публикации не заденет соседа)
+            cached_path = self._downloaded_media_cache.get(file_obj.file_unique_id)
+            if cached_path and os.path.exists(cached_path):
+                os.link(cached_path, file_path)
+            else:
+                self._download_file_streamed(file_obj, file_path)
+                self._downloaded_media_cache[file_obj.file_unique_id] = file_path
+                # Вытесняем самые старые записи, как в _media_id_cache
+                while len(self._downloaded_media_cache) > DOWNLOADED_MEDIA_CACHE_MAX:
+                    self._downloaded_media_cache.pop(next(iter(self._downloaded_media_cache)))
             
             # Для видео проверяем длительность
             if media_type == 'video':
@@ -1151,15 +1675,21 @@ class EnhancedInstagramBot:
             if time_text.lower() == 'now':
                 publish_time = datetime.utcnow()
             else:
-                # Парсим время
-                publish_time = datetime.strptime(time_text, "%d.%m.%Y %H:%M")
+                # Парсим время: предкомпилированный regex и прямой
+                # конструктор datetime вместо strptime
+                m = TIME_INPUT_RE.match(time_text)
+                if not m:
+                    raise ValueError(time_text)
+
+                publish_time = datetime(
+                    int(m[3]), int(m[2]), int(m[1]), int(m[4]), int(m[5])
+                )
                 
                 # Конвертируем в UTC (предполагаем московское время)
-                moscow_tz = pytz.timezone('Europe/Moscow')
-                publish_time = moscow_tz.localize(publish_time).astimezone(pytz.utc)
-                
+                publish_time = MOSCOW_TZ.localize(publish_time).astimezone(UTC)
+
                 # Проверяем, что время в будущем
-                if publish_time <= datetime.utcnow().replace(tzinfo=pytz.utc):
+                if publish_time <= datetime.utcnow().replace(tzinfo=UTC):
                     update.message.reply_text("❌ Время должно быть в будущем")
                     return
             
@@ -1182,10 +1712,9 @@ class EnhancedInstagramBot:
             )
             
             # Форматируем время для отображения
-            moscow_tz = pytz.timezone('Europe/Moscow')
-            display_time = publication.publish_time.replace(tzinfo=pytz.utc).astimezone(moscow_tz)
+            display_time = publication.publish_time.replace(tzinfo=UTC).astimezone(MOSCOW_TZ)
             
-            content_emoji = {"post": "📝", "story": "📸", "reel": "🎬"}.get(publication.content_type, "📄")
+            content_emoji = CONTENT_EMOJI.get(publication.content_type, DEFAULT_EMOJI)
             
             success_text = f"""
 {content_emoji} <b>Публикация добавлена в очередь!</b>
@@ -1263,8 +1792,8 @@ class EnhancedInstagramBot:
             )
             return
         
-        context.user_data['new_username'] = username
-        
+        self._pending_credentials[update.effective_user.id] = {'username': username}
+
         update.message.reply_text(
             "🔐 Введите пароль от аккаунта:\n\n"
             "⚠️ Пароль будет зашифрован и сохранен безопасно",
@@ -1276,8 +1805,9 @@ class EnhancedInstagramBot:
     def handle_password_input(self, update: Update, context: CallbackContext):
         """Обработка ввода пароля"""
         password = update.message.text
-        username = context.user_data.get('new_username')
-        
+        pending = self._pending_credentials.get(update.effective_user.id)
+        username = pending.get('username') if pending else None
+
         if not username:
             update.message.reply_text("❌ Ошибка: username не найден")
             return
@@ -1288,15 +1818,15 @@ class EnhancedInstagramBot:
         except:
             pass
         
-        context.user_data['new_password'] = password
-        
+        pending['password'] = password
+
         # Проверяем необходимость 2FA
         try:
-            methods = self.get_2fa_methods(username, password)
-            
+            cl, methods = self.probe_login(username, password)
+
             if not methods:
                 # 2FA не требуется, добавляем аккаунт
-                if self.add_account(username, password):
+                if self.add_account(username, password, client=cl):
                     success_text = f"✅ Аккаунт @{username} успешно добавлен!"
                     keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]]
                 else:
@@ -1308,14 +1838,17 @@ class EnhancedInstagramBot:
                     text=success_text,
                     reply_markup=InlineKeyboardMarkup(keyboard)
                 )
+                self._pending_credentials.pop(update.effective_user.id, None)
                 context.user_data.clear()
                 return
-            
+
             # Показываем доступные методы 2FA
             self.show_2fa_methods(update, context, methods)
             
         except Exception as e:
             self.logger.error(f"Password check error: {e}")
+            # Неудачная попытка — пароль не должен оставаться в памяти
+            self._pending_credentials.pop(update.effective_user.id, None)
             context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=f"❌ Ошибка входа: {str(e)}",
@@ -1326,30 +1859,12 @@ class EnhancedInstagramBot:
 
     def show_2fa_methods(self, update: Update, context: CallbackContext, methods: List[str]):
         """Показ доступных методов 2FA"""
-        method_names = {
-            'app': '📱 Приложение',
-            'sms': '💬 SMS',
-            'whatsapp': '💚 WhatsApp',
-            'call': '📞 Звонок',
-            'email': '📧 Email'
-        }
-        
-        keyboard = []
-        for method in methods:
-            if method in method_names:
-                keyboard.append([InlineKeyboardButton(
-                    method_names[method], 
-                    callback_data=f"2fa_method_{method}"
-                )])
-        
-        keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_account")])
-        
         text = "🔐 Требуется двухфакторная аутентификация\n\nВыберите способ получения кода:"
-        
+
         context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=two_fa_keyboard(tuple(methods))
         )
 
     def handle_2fa_method_selection(self, update: Update, context: CallbackContext):
@@ -1358,17 +1873,9 @@ class EnhancedInstagramBot:
         query.answer()
         
         method = query.data.split('_')[-1]  # Извлекаем метод из callback_data
-        context.user_data['2fa_method'] = method
-        
-        method_names = {
-            'app': 'приложения',
-            'sms': 'SMS',
-            'whatsapp': 'WhatsApp',
-            'call': 'звонка',
-            'email': 'email'
-        }
+        self._pending_credentials.setdefault(update.effective_user.id, {})['method'] = method
         
-        text = f"🔐 Введите 6-значный код из {method_names.get(method, method)}:"
+        text = f"🔐 Введите 6-значный код из {TWO_FA_METHOD_GENITIVE.get(method, method)}:"
         
         query.edit_message_text(
             text,
@@ -1381,9 +1888,10 @@ class EnhancedInstagramBot:
     def handle_2fa_code_input(self, update: Update, context: CallbackContext):
         """Обработка ввода кода 2FA"""
         code = update.message.text.strip()
-        username = context.user_data.get('new_username')
-        password = context.user_data.get('new_password')
-        method = context.user_data.get('2fa_method')
+        pending = self._pending_credentials.get(update.effective_user.id, {})
+        username = pending.get('username')
+        password = pending.get('password')
+        method = pending.get('method')
         
         # Удаляем сообщение с кодом
         try:
@@ -1397,7 +1905,16 @@ class EnhancedInstagramBot:
                 text="❌ Ошибка: данные не найдены"
             )
             return
-        
+
+        # Проверка формата без regex: не тратим полную попытку логина
+        # в Instagram на заведомо некорректный код
+        if not (len(code) == 6 and code.isdigit()):
+            context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="❌ Код должен состоять из 6 цифр. Введите код еще раз:"
+            )
+            return
+
         # Добавляем аккаунт с 2FA
         if self.add_account(username, password, code, method):
             success_text = f"✅ Аккаунт @{username} успешно добавлен с 2FA!"
@@ -1411,7 +1928,8 @@ class EnhancedInstagramBot:
             text=success_text,
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        
+
+        self._pending_credentials.pop(update.effective_user.id, None)
         context.user_data.clear()
 
     # ==================== ОБРАБОТЧИКИ НАСТРОЕК ====================
@@ -1496,18 +2014,25 @@ class EnhancedInstagramBot:
             
             update.effective_message.reply_text(error_text)
 
-    def start_bot(self):
-        """Запуск бота"""
-        updater = Updater(self.config.telegram.token)
+    def build_updater(self) -> Updater:
+        """Создание Updater с зарегистрированными обработчиками.
+
+        Выделено из start_bot, чтобы бота можно было встроить в внешний
+        процесс: вызывающая сторона сама решает, как крутить polling.
+        """
+        # Пул воркеров диспетчера: обработчики с run_async=True не
+        # сериализуются за одним потоком, и долгий login в Instagram
+        # у одного пользователя не блокирует остальных
+        updater = Updater(self.config.telegram.token, workers=8)
         dp = updater.dispatcher
 
         # Основные обработчики команд
-        dp.add_handler(CommandHandler("start", self.start))
-        dp.add_handler(CommandHandler("help", self.show_help))
-        dp.add_handler(CommandHandler("accounts", self.show_accounts_menu))
-        dp.add_handler(CommandHandler("queue", self.show_queue))
-        dp.add_handler(CommandHandler("stats", self.show_statistics))
-        dp.add_handler(CommandHandler("settings", self.show_settings_menu))
+        dp.add_handler(CommandHandler("start", self.start, run_async=True))
+        dp.add_handler(CommandHandler("help", self.show_help, run_async=True))
+        dp.add_handler(CommandHandler("accounts", self.show_accounts_menu, run_async=True))
+        dp.add_handler(CommandHandler("queue", self.show_queue, run_async=True))
+        dp.add_handler(CommandHandler("stats", self.show_statistics, run_async=True))
+        dp.add_handler(CommandHandler("settings", self.show_settings_menu, run_async=True))
 
         # ConversationHandler для добавления аккаунта
         add_account_conv = ConversationHandler(
@@ -1534,9 +2059,13 @@ class EnhancedInstagramBot:
             },
             fallbacks=[
                 CommandHandler('cancel', self.cancel_operation),
-                CallbackQueryHandler(self.cancel_operation, pattern="^cancel_")
+                # Только cancel-кнопки диалогов: cancel_pub_N должен
+                # дойти до handle_cancel_publication, а не оборвать диалог
+                CallbackQueryHandler(self.cancel_operation, pattern="^cancel_(add_account|upload)$")
             ],
-            per_user=True
+            per_user=True,
+            per_chat=False,
+            run_async=True
         )
         dp.add_handler(add_account_conv)
 
@@ -1569,27 +2098,35 @@ class EnhancedInstagramBot:
             },
             fallbacks=[
                 CommandHandler('cancel', self.cancel_operation),
-                CallbackQueryHandler(self.cancel_operation, pattern="^cancel_")
+                # Только cancel-кнопки диалогов: cancel_pub_N должен
+                # дойти до handle_cancel_publication, а не оборвать диалог
+                CallbackQueryHandler(self.cancel_operation, pattern="^cancel_(add_account|upload)$")
             ],
-            per_user=True
+            per_user=True,
+            per_chat=False,
+            run_async=True
         )
         dp.add_handler(add_content_conv)
 
         # Основной обработчик callback'ов
         callback_handlers = [
             # Главное меню
-            CallbackQueryHandler(self.callback_query_handler, pattern="^menu_"),
-            CallbackQueryHandler(self.show_main_menu, pattern="^back_to_main$"),
-            
+            CallbackQueryHandler(self.callback_query_handler, pattern="^menu_", run_async=True),
+            CallbackQueryHandler(self.show_main_menu, pattern="^back_to_main$", run_async=True),
+
             # Аккаунты
-            CallbackQueryHandler(self.handle_account_callbacks, pattern="^account_"),
-            
+            CallbackQueryHandler(self.handle_account_callbacks, pattern="^account_", run_async=True),
+
             # Настройки
-            CallbackQueryHandler(self.handle_settings_callbacks, pattern="^toggle_"),
-            CallbackQueryHandler(self.handle_settings_callbacks, pattern="^change_"),
-            
+            CallbackQueryHandler(self.handle_settings_callbacks, pattern="^toggle_", run_async=True),
+            CallbackQueryHandler(self.handle_settings_callbacks, pattern="^change_", run_async=True),
+
+            # Очередь: отмена публикации (регистрируется до общего
+            # ^cancel_, иначе callback перехватит cancel_operation)
+            CallbackQueryHandler(self.handle_cancel_publication, pattern="^cancel_pub_", run_async=True),
+
             # Общие callback'ы
-            CallbackQueryHandler(self.cancel_operation, pattern="^cancel_"),
+            CallbackQueryHandler(self.cancel_operation, pattern="^cancel_", run_async=True),
         ]
         
         for handler in callback_handlers:
@@ -1598,22 +2135,41 @@ class EnhancedInstagramBot:
         # Обработчик ошибок
         dp.add_error_handler(self.error_handler)
 
-        # Запуск планировщика
+        return updater
+
+    def start_background_tasks(self):
+        """Запуск фоновых потоков: планировщик и еженедельные отчеты"""
         scheduler_thread = Thread(target=self.scheduler, daemon=True)
         scheduler_thread.start()
 
-        # Запуск отправки еженедельных отчетов
         if self.config.notifications.weekly_reports:
             reports_thread = Thread(target=self.weekly_reports_scheduler, daemon=True)
             reports_thread.start()
 
+    def start_bot(self):
+        """Запуск бота"""
+        updater = self.build_updater()
+        self.start_background_tasks()
+
         self.logger.info("Enhanced Instagram Bot started successfully")
-        
+
         try:
-            if self.config.telegram.use_webhook:
+            if self.config.telegram.use_webhook and not self.config.telegram.webhook_url:
+                self.logger.warning(
+                    "USE_WEBHOOK is set but WEBHOOK_URL is empty, falling back to polling"
+                )
+
+            if self.config.telegram.use_webhook and self.config.telegram.webhook_url:
                 self.setup_webhook(updater)
             else:
-                updater.start_polling(timeout=30, read_latency=10)
+                # Длинный long-poll уже стоит; allowed_updates отсекает
+                # типы апдейтов, которые бот все равно не обрабатывает
+                updater.start_polling(
+                    timeout=30,
+                    read_latency=10,
+                    bootstrap_retries=-1,
+                    allowed_updates=["message", "callback_query"]
+                )
             
             updater.idle()
         except KeyboardInterrupt:
@@ -1622,6 +2178,9 @@ class EnhancedInstagramBot:
             self.logger.error(f"Bot error: {e}")
         finally:
             self.scheduler_running = False
+            self._scheduler_wake.set()
+            for executor in self._account_executors.values():
+                executor.shutdown(wait=True)
             self.logger.info("Bot shutdown complete")
 
     def setup_webhook(self, updater):
@@ -1630,7 +2189,8 @@ class EnhancedInstagramBot:
             listen=self.config.telegram.webhook_listen,
             port=self.config.telegram.webhook_port,
             url_path=self.config.telegram.token,
-            webhook_url=f"{self.config.telegram.webhook_url}/{self.config.telegram.token}"
+            webhook_url=f"{self.config.telegram.webhook_url}/{self.config.telegram.token}",
+            allowed_updates=["message", "callback_query"]
         )
         self.logger.info(f"Webhook setup completed on {self.config.telegram.webhook_url}")
 
@@ -1640,44 +2200,17 @@ class EnhancedInstagramBot:
         if query:
             query.answer()
         
-        keyboard = [
-            [
-                InlineKeyboardButton("📱 Аккаунты", callback_data="menu_accounts"),
-                InlineKeyboardButton("📝 Добавить пост", callback_data="menu_add_post")
-            ],
-            [
-                InlineKeyboardButton("📸 Добавить Story", callback_data="menu_add_story"),
-                InlineKeyboardButton("🎬 Добавить Reel", callback_data="menu_add_reel")
-            ],
-            [
-                InlineKeyboardButton("📋 Очередь", callback_data="menu_queue"),
-                InlineKeyboardButton("📊 Статистика", callback_data="menu_stats")
-            ],
-            [
-                InlineKeyboardButton("⚙️ Настройки", callback_data="menu_settings"),
-                InlineKeyboardButton("❓ Помощь", callback_data="menu_help")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        welcome_text = """
-🤖 <b>Enhanced Instagram Bot</b>
-
-Главное меню - выберите действие:
-        """
-        
         if query:
             query.edit_message_text(
-                welcome_text,
+                MAIN_MENU_TEXT,
                 parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
+                reply_markup=MAIN_MENU_MARKUP
             )
         else:
             update.message.reply_text(
-                welcome_text,
+                MAIN_MENU_TEXT,
                 parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
+                reply_markup=MAIN_MENU_MARKUP
             )
 
     def handle_account_callbacks(self, update: Update, context: CallbackContext):
@@ -1761,6 +2294,7 @@ class EnhancedInstagramBot:
 
     def cancel_operation(self, update: Update, context: CallbackContext):
         """Отмена текущей операции"""
+        self._pending_credentials.pop(update.effective_user.id, None)
         context.user_data.clear()
         
         if update.callback_query: